@@ -43,7 +43,9 @@ try:
     print('Waiting for finger...')
 
     ## Wait that finger is read
-    while ( f.readImage() == False ):
+    ## (bind the method once so the polling loop skips the attribute lookup)
+    readImage = f.readImage
+    while ( readImage() == False ):
         pass
 
     ## Converts read image to characteristics and stores it in charbuffer 1
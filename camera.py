@@ -1,51 +1,136 @@
+import atexit
+import queue
+import threading
 import time
+
+import cv2
 from picamera2 import Picamera2
 
 # A simple Python script to capture and save an image from the Raspberry Pi Camera.
 
-def capture_image():
+class Camera:
     """
-    Initializes the Picamera2, shows a preview, and captures a still image.
+    Keeps the Picamera2 pipeline running between captures so the sensor only
+    has to warm up once, and writes images to disk on a background thread.
     """
-    print("Initializing camera...")
-    
-    # Create an instance of the Picamera2 class.
-    # This class provides the main interface to the camera.
-    picam2 = Picamera2()
-    
-    try:
-        # Create a preview window. This will open a window on your desktop
-        # showing what the camera sees.
-        picam2.start_preview()
-        
-        # Start the camera.
-        picam2.start()
-        
-        # Give the camera sensor some time to adjust to the light conditions.
-        # This prevents the first few frames from being underexposed.
-        print("Camera preview started. Waiting 2 seconds for sensor to adjust...")
-        time.sleep(2)
-        
+
+    def __init__(self):
+        print("Initializing camera...")
+
+        # Create an instance of the Picamera2 class.
+        # This class provides the main interface to the camera.
+        self.picam2 = Picamera2()
+
+        try:
+            # RGB888 frames come out in the BGR byte order OpenCV expects,
+            # so they can be written with cv2.imwrite without any conversion.
+            config = self.picam2.create_still_configuration(
+                main={"size": (1920, 1080), "format": "RGB888"})
+            self.picam2.configure(config)
+
+            # Create a preview window. This will open a window on your desktop
+            # showing what the camera sees.
+            self.picam2.start_preview()
+
+            # Start the camera.
+            self.picam2.start()
+
+            # Give the camera sensor some time to adjust to the light conditions.
+            # This prevents the first few frames from being underexposed.
+            # Because the camera stays running, this only happens once.
+            print("Camera preview started. Waiting 2 seconds for sensor to adjust...")
+            time.sleep(2)
+
+        except Exception:
+            # Release the hardware resources even though setup failed,
+            # otherwise the next run can't open the camera.
+            self.picam2.close()
+            raise
+
+        # Encoding and saving the image is slower than grabbing a frame, so
+        # hand it to a writer thread. The queue is bounded so a slow SD card
+        # cannot make frames pile up in memory.
+        self._write_queue = queue.Queue(maxsize=4)
+        self._writer = threading.Thread(target=self._write_worker, daemon=True)
+        self._writer.start()
+
+    def capture(self, filename=None):
+        """
+        Grabs the current frame and queues it to be saved as a JPEG.
+        Returns the filename the image will be written to.
+        """
         # Create a unique filename for the image using a timestamp.
-        # This prevents overwriting previous photos.
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        filename = f"capture-{timestamp}.jpg"
-        
-        # Capture a still image and save it to the specified filename.
-        print(f"Capturing image and saving to {filename}...")
-        picam2.capture_file(filename)
-        
-        print("Image captured successfully!")
+        # This prevents overwriting previous photos. Captures are cheap now,
+        # so add microseconds to keep two in the same second apart.
+        if filename is None:
+            now_ns = time.time_ns()
+            timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now_ns // 1_000_000_000))
+            filename = f"capture-{timestamp}-{now_ns // 1000 % 1_000_000:06d}.jpg"
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+        frame = self.picam2.capture_array("main")
+        self._write_queue.put((frame, filename))
+        return filename
+
+    def _write_worker(self):
+        while True:
+            frame, filename = self._write_queue.get()
+            try:
+                print(f"Saving image to {filename}...")
+                # imwrite reports failure by returning False, not by raising
+                if cv2.imwrite(filename, frame):
+                    print(f"Image saved to {filename}")
+                else:
+                    print(f"Failed to save image to {filename}")
+            except Exception as e:
+                print(f"An error occurred while saving {filename}: {e}")
+            finally:
+                self._write_queue.task_done()
+
+    def close(self):
+        """
+        Waits for pending images to be written, then releases the camera.
+        """
+        self._write_queue.join()
 
-    finally:
         # Stop the camera and the preview to release the hardware resources.
         # This is a crucial step to prevent errors on subsequent runs.
-        picam2.stop_preview()
-        picam2.stop()
+        self.picam2.stop_preview()
+        self.picam2.stop()
         print("Camera stopped and resources released.")
 
+
+# Shared by capture_image() so only the first call pays for initializing
+# the camera and waiting for the sensor to adjust.
+_camera = None
+
+def capture_image():
+    """
+    Captures and saves a still image, starting the shared camera on first use.
+    The camera stays running until release_camera() is called or the program exits.
+    """
+    global _camera
+
+    try:
+        if _camera is None:
+            _camera = Camera()
+        print("Capturing image...")
+        _camera.capture()
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+def release_camera():
+    """
+    Waits for pending images to be written and releases the shared camera.
+    """
+    global _camera
+
+    if _camera is not None:
+        _camera.close()
+        _camera = None
+
+# Make sure queued images are written and the camera is released on exit.
+atexit.register(release_camera)
+
 if __name__ == "__main__":
     capture_image()
@@ -1,49 +1,284 @@
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FfmpegOutput
+from picamera2 import Picamera2, MappedArray
+from picamera2.encoders import H264Encoder, MJPEGEncoder
+from picamera2.outputs import FfmpegOutput, FileOutput
+import cv2
+import numpy as np
+import os
 import time
 import io
+import queue
 import threading
 from threading import Lock
 
-class CameraControl:
+# libjpeg-turbo (NEON SIMD on the Pi) is much faster than the libjpeg most
+# OpenCV builds link against; fall back to cv2.imencode when it's missing.
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+except ImportError:
+    TurboJPEG = None
+
+class StreamingOutput(io.BufferedIOBase):
+    # Holds the latest JPEG frame; one encode is shared by every viewer.
+    # The (sequence, jpeg) tuple is swapped in with a single assignment, so
+    # viewers can read it without a lock and only sleep when nothing is new.
     def __init__(self):
-        self.camera = Picamera2()
-        self.lock = Lock()
+        self.latest = (0, None)
+        self.condition = threading.Condition()
+
+    def write(self, buf):
+        self.latest = (self.latest[0] + 1, buf)
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait_for_frame(self, last_sequence):
+        sequence, frame = self.latest
+        if sequence == last_sequence:
+            with self.condition:
+                self.condition.wait_for(lambda: self.latest[0] != last_sequence)
+            sequence, frame = self.latest
+        return sequence, frame
+
+class CameraControl:
+    # JPEG works in YCbCr 4:2:0, so asking the ISP for YUV420 lets the
+    # encoder skip its own RGB -> YCbCr pass on every frame.
+    # The full-size main stream feeds recording and stills; the preview is
+    # encoded from the ISP's lores output, which costs no extra CPU to scale.
+    MAIN_SIZE = (1920, 1080)
+    PREVIEW_SIZE = (640, 360)
+
+    # A live preview doesn't need near-lossless frames; Q75 roughly halves
+    # the JPEG size. Always baseline 4:2:0 - progressive encoding is many
+    # times slower on ARM.
+    PREVIEW_QUALITY = 75
+    STILL_QUALITY = 90
+
+    # Core the software encoder is pinned to, leaving 0-1 for the camera
+    # stack and the web server
+    ENCODE_CPU = 2
+
+    # Multipart framing around each JPEG, built once rather than per frame
+    PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+    PART_HEADER_END = b'\r\n\r\n'
+    PART_TRAILER = b'\r\n'
+
+    # Output filename templates, filled in with a timestamp
+    TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+    RECORDING_NAME = 'recording_{}.mp4'
+    # Fragmented MP4 is written as it goes, so stopping doesn't have to
+    # rewrite the index and a power cut only loses the last fragment
+    RECORDING_FLAGS = '-movflags +frag_keyframe+empty_moov+default_base_moof'
+    CAPTURE_NAME = 'capture_{}.jpg'
+
+    def __init__(self, frame_interval=0, hardware_mjpeg=True):
+        # Minimum seconds between frames sent to a viewer; 0 streams at the
+        # camera's own rate. Useful to cap bandwidth for remote clients.
+        self.frame_interval = frame_interval
+        # Picamera2 serialises camera access itself; this only guards the
+        # recording state so start/stop can't race each other
+        self.recording_lock = Lock()
         self.recording = False
-        self.configure_camera()
+        self.jpeg = None
+        if TurboJPEG is not None:
+            # PyTurboJPEG imports fine without the native libturbojpeg and
+            # only fails here, so treat that like it isn't installed
+            try:
+                self.jpeg = TurboJPEG()
+            except (OSError, RuntimeError) as e:
+                print(f"libturbojpeg could not be loaded, using OpenCV for JPEG: {e}")
+        self.stream = StreamingOutput()
+        self.camera = Picamera2()
+        try:
+            self.configure_camera()
+            self.start_streaming(hardware_mjpeg)
+        except Exception:
+            # Release the camera so it can be opened again
+            self.camera.close()
+            raise
         
     def configure_camera(self):
         # Configure camera for both preview and recording
-        video_config = self.camera.create_video_configuration()
+        video_config = self.camera.create_video_configuration(
+            main={"size": self.MAIN_SIZE, "format": "YUV420"},
+            lores={"size": self.PREVIEW_SIZE, "format": "YUV420"})
         self.camera.configure(video_config)
+        self.main_geometry = self.stream_geometry("main")
+        self.preview_geometry = self.stream_geometry("lores")
         self.camera.start()
         time.sleep(2)  # Allow camera to warm up
         
+    def stream_geometry(self, name):
+        # libcamera may adjust the requested size and pad each row, so use
+        # what it actually configured rather than the class constants
+        config = self.camera.camera_config[name]
+        width, height = config["size"]
+        return width, height, config["stride"]
+
+    def start_streaming(self, hardware_mjpeg):
+        if hardware_mjpeg:
+            try:
+                # Let the Pi's hardware JPEG block encode the preview so the
+                # CPU doesn't have to touch each frame at all
+                self.mjpeg_encoder = MJPEGEncoder()
+                self.camera.start_encoder(self.mjpeg_encoder, FileOutput(self.stream),
+                                          name="lores")
+                return
+            except Exception as e:
+                print(f"Hardware MJPEG encoder unavailable, encoding in software: {e}")
+        if self.jpeg is None:
+            # Each frame is encoded by a single call; OpenCV's thread pool only
+            # adds hand-off overhead for work that small. This is process-wide,
+            # so only do it when OpenCV really is the encoder.
+            cv2.setNumThreads(1)
+        if self.jpeg is None and 'turbo' not in cv2.getBuildInformation().lower():
+            # Debian's OpenCV links libjpeg62-turbo as plain libjpeg, so this
+            # can't be certain either way
+            print("Warning: could not confirm that OpenCV uses libjpeg-turbo; "
+                  "software JPEG encoding may be slow. Install PyTurboJPEG.")
+        # Capture and encode once in the background instead of per client.
+        # libcamera already captures asynchronously, so the hand-off only
+        # keeps the newest completed request: every held request pins a main
+        # and a lores buffer, and the recorder needs some of the six too.
+        self.pending = queue.Queue(maxsize=1)
+        self.capturer = threading.Thread(target=self.capture_frames, daemon=True)
+        self.producer = threading.Thread(target=self.produce_frames, daemon=True)
+        self.capturer.start()
+        self.producer.start()
+
+    def capture_frames(self):
+        while True:
+            try:
+                request = self.camera.capture_request()
+            except Exception as e:
+                # Keep the thread alive; a dead capturer would leave every
+                # viewer waiting forever
+                print(f"Preview capture failed: {e}")
+                time.sleep(0.1)
+                continue
+            try:
+                self.pending.put_nowait(request)
+            except queue.Full:
+                # Replace the waiting frame rather than let the preview lag behind
+                try:
+                    self.pending.get_nowait().release()
+                except queue.Empty:
+                    pass
+                self.pending.put_nowait(request)
+
+    def produce_frames(self):
+        # Stay on one core so the encoder's caches aren't lost to migration.
+        # Only if that core is allowed (cpusets/taskset may exclude it), and
+        # never let a failed pin take the encoder thread down.
+        if hasattr(os, "sched_setaffinity") and self.ENCODE_CPU in os.sched_getaffinity(0):
+            try:
+                os.sched_setaffinity(0, {self.ENCODE_CPU})
+            except OSError as e:
+                print(f"Could not pin the preview encoder to CPU {self.ENCODE_CPU}: {e}")
+        while True:
+            request = self.pending.get()
+            try:
+                # Encode straight out of the camera's buffer rather than
+                # copying each frame with capture_array
+                with MappedArray(request, "lores") as m:
+                    jpeg = self.encode_jpeg(m.array, self.preview_geometry,
+                                            self.PREVIEW_QUALITY)
+            except Exception as e:
+                print(f"Preview encode failed: {e}")
+                jpeg = None
+            finally:
+                # Always hand the buffer back or the camera runs out of them
+                request.release()
+            if jpeg is not None:
+                self.stream.write(jpeg)
+
     def get_frame(self):
+        last_sent = 0
+        sequence = 0
+        trailer = b''
         while True:
-            with self.lock:
-                frame = self.camera.capture_array("main")
-                ret, jpeg = cv2.imencode('.jpg', frame)
-                if not ret:
-                    continue
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n\r\n')
-            time.sleep(0.1)
+            if self.frame_interval:
+                delay = self.frame_interval - (time.monotonic() - last_sent)
+                if delay > 0:
+                    time.sleep(delay)
+            # Wait for the producer to publish a new frame; this also paces
+            # the stream to the camera's frame rate
+            sequence, jpeg = self.stream.wait_for_frame(sequence)
+            last_sent = time.monotonic()
+            # Yield the JPEG on its own so it is handed to the socket as-is
+            # instead of being copied into a concatenated part. The previous
+            # part's trailer rides along with this header, so each frame is
+            # two writes rather than three.
+            yield (trailer + self.PART_HEADER + str(len(jpeg)).encode()
+                   + self.PART_HEADER_END)
+            yield jpeg
+            trailer = self.PART_TRAILER
+
+    def pack_i420(self, frame, geometry):
+        # Both encoders want tightly packed I420, so drop any row padding.
+        # Unpadded frames are returned as a view without copying.
+        width, height, stride = geometry
+        buf = np.asarray(frame).reshape(-1)
+        if stride == width:
+            return buf[:width * height * 3 // 2]
+        y_size = stride * height
+        chroma_stride = stride // 2
+        chroma_size = chroma_stride * (height // 2)
+        y = buf[:y_size].reshape(height, stride)[:, :width]
+        u = buf[y_size:y_size + chroma_size].reshape(height // 2, chroma_stride)[:, :width // 2]
+        v = buf[y_size + chroma_size:y_size + 2 * chroma_size].reshape(
+            height // 2, chroma_stride)[:, :width // 2]
+        return np.concatenate((y.reshape(-1), u.reshape(-1), v.reshape(-1)))
+
+    def encode_jpeg(self, frame, geometry, quality):
+        # frame is a planar YUV420 (I420) buffer of the given stream geometry
+        frame = self.pack_i420(frame, geometry)
+        width, height, _ = geometry
+        if self.jpeg is not None:
+            return self.jpeg.encode_from_yuv(frame, height, width, quality=quality,
+                                             jpeg_subsample=TJSAMP_420)
+        bgr = cv2.cvtColor(frame.reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420)
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality,
+                  cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                  cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+        # OpenCV < 4.5.5 has no sampling flag; libjpeg then defaults to 4:2:0
+        if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+        ret, jpeg = cv2.imencode('.jpg', bgr, params)
+        if not ret:
+            return None
+        return jpeg.tobytes()
             
     def start_recording(self):
-        if not self.recording:
-            self.recording = True
-            self.encoder = H264Encoder()
-            timestamp = time.strftime("%Y%m%d-%H%M%S")
-            self.output = FfmpegOutput(f'recording_{timestamp}.mp4')
-            self.camera.start_encoder(self.encoder, self.output)
+        with self.recording_lock:
+            if not self.recording:
+                self.recording = True
+                self.encoder = H264Encoder()
+                timestamp = time.strftime(self.TIMESTAMP_FORMAT)
+                # FfmpegOutput splits this string into extra ffmpeg arguments
+                self.output = FfmpegOutput(
+                    f'{self.RECORDING_FLAGS} {self.RECORDING_NAME.format(timestamp)}')
+                self.camera.start_encoder(self.encoder, self.output)
             
     def stop_recording(self):
-        if self.recording:
-            self.recording = False
-            self.camera.stop_encoder()
+        with self.recording_lock:
+            if self.recording:
+                self.recording = False
+                # Only stop the recorder; the preview may have its own encoder
+                self.camera.stop_encoder(self.encoder)
             
-    def capture_image(self):
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        self.camera.capture_file(f'capture_{timestamp}.jpg')
\ No newline at end of file
+    def capture_image(self, fast=False):
+        timestamp = time.strftime(self.TIMESTAMP_FORMAT)
+        # fast=True saves the JPEG the preview already encoded, which costs
+        # nothing beyond the file write, but it is only the 640x360 lores
+        # frame (bitrate-limited on the hardware path) and may be stale if
+        # the preview has stopped
+        jpeg = self.stream.latest[1] if fast else None
+        if jpeg is None:
+            # Full-resolution still from the main stream. capture_file can't
+            # turn a YUV420 stream into an image, so encode the frame
+            # ourselves with the same JPEG path as the stream.
+            frame = self.camera.capture_array("main")
+            jpeg = self.encode_jpeg(frame, self.main_geometry, self.STILL_QUALITY)
+            if jpeg is None:
+                return
+        with open(self.CAPTURE_NAME.format(timestamp), 'wb') as f:
+            f.write(jpeg)
\ No newline at end of file